@@ -19,6 +19,7 @@ Options:
   --github-token=<token>               or use env var GITHUB_TOKEN.
   --zenhub-token=<token>               or use env var ZENHUB_TOKEN.
   --timeout=<seconds>                  How long to wait for apis [Default: 180]
+  --concurrency=<requests>             How many api requests to send at once [Default: 10]
   -h, --help                           Show this screen.
 
 For ZenHub the following fields are available.
@@ -32,12 +33,48 @@ For Projects the fields are customisable. However the following are special
 
 """
 
-from docopt import docopt
+import aiohttp
+import argparse
+import asyncio
+import collections
+import dataclasses
 import difflib
+import functools
+import gc
 from gql import gql, Client, transport
+from gql.transport import exceptions as transport_exceptions
 from gql.transport.aiohttp import AIOHTTPTransport
+from graphql import ExecutionResult
+from graphql.language import (
+    DocumentNode,
+    FieldNode,
+    NameNode,
+    OperationDefinitionNode,
+    OperationType,
+    SelectionSetNode,
+    VariableNode,
+    Visitor,
+    print_ast,
+    visit,
+)
 import os
 import fnmatch
+import random
+import re
+import sys
+import time
+
+try:
+    import rapidfuzz
+    import rapidfuzz.fuzz
+    import rapidfuzz.process
+except ImportError:
+    rapidfuzz = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 default_mapping = [
     "Estimate:Size:Scale",
@@ -54,215 +91,645 @@ default_mapping = [
 TEXT = {"type": "body"}
 FIXES = {"type": "Linked pull requests"}
 
+# Zenhub's default estimate scale. Shared so it isn't rebuilt for every issue
+STORY_POINTS = (40, 21, 13, 8, 5, 3, 2, 1)
+
+# How many batch documents to keep built, and printed documents per api.
+# Mixed batches rarely repeat
+BATCH_DOCUMENTS = 256
+PRINTED_DOCUMENTS = 512
+
+# gql's execute_timeout raises the builtin TimeoutError, which before python 3.11 isn't asyncio's
+TIMEOUTS = (asyncio.TimeoutError, TimeoutError)
 
-def merge_workspaces(project_url, workspace, field, **args):
+# owner, repo and number of an issue or pull request url
+ISSUE_URL = re.compile(r"https://github\.com/([^/]+)/([^/]+)/(?:issues?|pull)/(\d+)")
+
+
+async def merge_workspaces(project_url, workspace, field, **args):
+    concurrency = int(args.pop("concurrency"))
     # Create a GraphQL client using the defined transport
     token = os.environ["ZENHUB_TOKEN"] if not args["zenhub_token"] else args["zenhub_token"]
-    zh_query = Client(
-        transport=AIOHTTPTransport(
+    zh_client = Client(
+        transport=PrintedTransport(
             url="https://api.zenhub.com/public/graphql",
             headers={"Authorization": f"Bearer {token}"},
+            client_session_args=session_args(concurrency),
         ),
-        fetch_schema_from_transport=True,
-        serialize_variables=True,
+        fetch_schema_from_transport=False,
         execute_timeout=int(args['timeout']),
-    ).execute
+    )
     token = os.environ["GITHUB_TOKEN"] if not args["github_token"] else args["github_token"]
-    gh_query = Client(
-        transport=AIOHTTPTransport(
+    gh_client = Client(
+        transport=PrintedTransport(
             url="https://api.github.com/graphql",
             headers={"Authorization": f"Bearer {token}"},
+            client_session_args=session_args(concurrency),
         ),
         fetch_schema_from_transport=False,
-        serialize_variables=True,
         execute_timeout=int(args['timeout']),
-    ).execute
+    )
+
+    # Keep one session open for the whole run rather than a new connection per query
+    async with zh_client as zh_session, gh_client as gh_session:
+        # Only hold a slot while a request is sent, not while waiting to retry it
+        zh_query = retrying(rate_gated(bounded(zh_session.execute, concurrency)))
+        gh_query = retrying(rate_gated(bounded(gh_session.execute, concurrency)))
+        return await sync_project(project_url, workspace, field, zh_query, gh_query, **args)
+
+
+def keepalive_connector(concurrency):
+    """ pool a connection per concurrent request and keep them open while the other api is busy """
+    # Each api is a single host so a pool can't be shared between them.
+    # Just look the host up less often
+    return aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=120, ttl_dns_cache=300)
+
+
+def session_args(concurrency):
+    """ aiohttp session options.
+    Use orjson if installed as parsing the item pages is most of our cpu """
+    args = dict(connector=keepalive_connector(concurrency))
+    if orjson is not None:
+        args.update(
+            json_serialize=lambda obj: orjson.dumps(obj).decode(), response_class=OrjsonResponse
+        )
+    return args
+
+
+class PrintedTransport(AIOHTTPTransport):
+    """ aiohttp transport that prints each document once rather than on every request.
+    Results and errors keep the headers of their own response, as requests run concurrently.
+    execute follows gql 3.5's, which is why gql is pinned to 3.5 """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Keep the document with its text so its id can't be reused by another while cached
+        self.printed = collections.OrderedDict()
+
+    async def execute(self, document, variable_values=None, operation_name=None, extra_args=None):
+        key = id(document)
+        if key in self.printed:
+            self.printed.move_to_end(key)
+        else:
+            self.printed[key] = document, print_ast(document)
+            if len(self.printed) > PRINTED_DOCUMENTS:
+                self.printed.popitem(last=False)
+        payload = dict(query=self.printed[key][1])
+        if variable_values:
+            payload["variables"] = variable_values
+        if operation_name:
+            payload["operationName"] = operation_name
+        if self.session is None:
+            raise transport_exceptions.TransportClosed("Transport is not connected")
+
+        async with self.session.post(
+            self.url, ssl=self.ssl, json=payload, **(extra_args or {})
+        ) as resp:
+            # Same handling as AIOHTTPTransport. Error statuses can still have a graphql result
+            try:
+                result = await resp.json(content_type=None)
+            except Exception:
+                result = None
+            if not isinstance(result, dict) or ("data" not in result and "errors" not in result):
+                try:
+                    resp.raise_for_status()
+                except aiohttp.ClientResponseError as e:
+                    error = transport_exceptions.TransportServerError(str(e), e.status)
+                    error.headers = resp.headers
+                    raise error from e
+                raise transport_exceptions.TransportProtocolError(
+                    f"Server did not return a GraphQL result: {await resp.text()}"
+                )
+            if result.get("errors"):
+                # Raised here rather than by the session so the headers go with it
+                error = transport_exceptions.TransportQueryError(
+                    str(result["errors"][0]),
+                    errors=result["errors"],
+                    data=result.get("data"),
+                    extensions=result.get("extensions"),
+                )
+                error.headers = resp.headers
+                raise error
+            return Response(
+                resp.headers, data=result.get("data"), extensions=result.get("extensions")
+            )
+
+
+class Response(ExecutionResult):
+    """ execution result with the headers of the response it came from """
+
+    def __init__(self, headers, **kwargs):
+        super().__init__(**kwargs)
+        self.headers = headers
+
+
+class OrjsonResponse(aiohttp.ClientResponse):
+    async def json(self, *, loads=None, **kwargs):
+        return await super().json(loads=loads or orjson.loads, **kwargs)
+
+
+def retrying(query, attempts=8):
+    """ retry rate limited, timed out or failed requests with exponential backoff and jitter """
+
+    async def execute(document, variables=None):
+        for attempt in range(attempts):
+            try:
+                return await query(document, variables)
+            except (
+                transport_exceptions.TransportQueryError,
+                transport_exceptions.TransportServerError,
+                aiohttp.ClientError,
+                *TIMEOUTS,
+            ) as e:
+                if attempt == attempts - 1 or not should_retry(e, document):
+                    raise
+                delay = retry_delay(getattr(e, "headers", None) or {}, attempt)
+                if isinstance(e, TIMEOUTS) and (variables or {}).get("first", 0) > 1:
+                    # Smaller pages are less likely to time out again
+                    variables = dict(variables, first=variables["first"] // 2)
+                print(f"Retrying in {delay:.0f}s - {type(e).__name__}: {e}")
+                await asyncio.sleep(delay)
+
+    return execute
+
+
+def rate_gated(query):
+    """ once a response says the rate limit is used up hold all requests until it resets rather
+    than fail each one.
+    query is a session execute. Returns the data of the result """
+    reset = 0
+
+    async def execute(document, variables=None):
+        nonlocal reset
+        if reset > time.time():
+            await asyncio.sleep(reset - time.time())
+        headers = {}
+        try:
+            result = await query(document, variables, get_execution_result=True)
+            headers = result.headers
+            return result.data
+        except transport_exceptions.TransportError as e:
+            headers = getattr(e, "headers", None) or {}
+            raise
+        finally:
+            if headers.get("X-RateLimit-Remaining") == "0" and headers.get("X-RateLimit-Reset"):
+                reset = max(reset, int(headers["X-RateLimit-Reset"]) + 1)
+
+    return execute
+
+
+def should_retry(e, document):
+    if isinstance(e, transport_exceptions.TransportQueryError):
+        # Github reports rate limiting as a graphql error
+        return any(err.get("type") == "RATE_LIMITED" for err in e.errors or [])
+    elif isinstance(e, transport_exceptions.TransportServerError) and e.code in (403, 429):
+        # Github uses 403 for its secondary rate limit. Nothing was run
+        return True
+    elif isinstance(e, transport_exceptions.TransportServerError):
+        # A server error might come after the mutation was run
+        return e.code in (500, 502, 503, 504) and repeatable(document)
+    # Timed out or failed on the way so it might have been run already
+    return repeatable(document)
+
+
+# Mutations that leave things the same however many times they are sent
+REPEATABLE_MUTATIONS = {
+    "addProjectV2ItemById",
+    "updateProjectV2ItemFieldValue",
+    "clearProjectV2ItemFieldValue",
+    "updateProjectV2ItemPosition",
+    "updateIssue",
+    "updatePullRequest",
+}
+
+
+def repeatable(document):
+    """ True if sending the document again can't do more than sending it once """
+    operation = document.definitions[0]
+    if operation.operation != OperationType.MUTATION:
+        return True
+    return all(
+        field.name.value in REPEATABLE_MUTATIONS for field in operation.selection_set.selections
+    )
+
+
+def retry_delay(headers, attempt):
+    """ seconds to wait using the rate limit headers if given otherwise exponential backoff """
+    if headers.get("Retry-After"):
+        return int(headers["Retry-After"])
+    elif headers.get("X-RateLimit-Remaining") == "0" and headers.get("X-RateLimit-Reset"):
+        return max(int(headers["X-RateLimit-Reset"]) - time.time(), 0) + 1
+    return min(2**attempt, 60) + random.uniform(0, 1)
+
+
+def bounded(query, limit):
+    """ wrap a session execute so no more than limit requests are in flight at once """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def execute(document, variables=None, **kwargs):
+        async with semaphore:
+            return await query(document, variables, **kwargs)
+
+    return execute
+
+
+def deferred(ops):
+    """ queue (document, variables) on ops instead of sending them so they can be batched later """
+
+    def execute(document, variables=None):
+        ops.append((document, variables))
+
+    return execute
+
+
+async def send_batch(query, ops, size=20, ordered=False):
+    """ send (document, variables) pairs as aliased documents of up to size operations each.
+    Mutations in a document run in order. ordered also waits for each document before the next """
+    order = list(range(len(ops)))
+    if not ordered:
+        # Put the same documents together so batches come in fewer shapes
+        order.sort(key=lambda i: id(ops[i][0]))
+    chunks = [[ops[i] for i in order[start : start + size]] for start in range(0, len(ops), size)]
+
+    def send(chunk):
+        return query(
+            batch_document(tuple(document for document, _ in chunk)),
+            {
+                f"{k}_{i}": v
+                for i, (_, variables) in enumerate(chunk)
+                for k, v in (variables or {}).items()
+            },
+        )
+
+    if ordered:
+        results = [await send(chunk) for chunk in chunks]
+    else:
+        results = await asyncio.gather(*(send(chunk) for chunk in chunks))
+    sent = [res[f"op{i}"] for chunk, res in zip(chunks, results) for i in range(len(chunk))]
+    # back in the order given
+    returned = [None] * len(ops)
+    for i, res in zip(order, sent):
+        returned[i] = res
+    return returned
+
+
+# Most recently used batch documents by the ids of the documents in them
+batch_documents = collections.OrderedDict()
+
 
+def batch_document(documents):
+    """
+    combine single field operations into one with fields aliased op0, op1... and variables
+    suffixed _0, _1...
+
+      >>> issue = gql("query($id: ID!) { node(id: $id) { id } }")
+      >>> print(print_ast(batch_document((issue, issue))))
+      query ($id_0: ID!, $id_1: ID!) {
+        op0: node(id: $id_0) {
+          id
+        }
+        op1: node(id: $id_1) {
+          id
+        }
+      }
+    """
+    key = tuple(id(document) for document in documents)
+    if key in batch_documents:
+        batch_documents.move_to_end(key)
+        return batch_documents[key]
+
+    class Suffix(Visitor):
+        def __init__(self, i):
+            super().__init__()
+            self.i = i
+
+        def enter_variable(self, node, *_):
+            return VariableNode(name=NameNode(value=f"{node.name.value}_{self.i}"))
+
+    variables, selections = [], []
+    for i, document in enumerate(documents):
+        operation = visit(document.definitions[0], Suffix(i))
+        variables.extend(operation.variable_definitions)
+        field, = operation.selection_set.selections
+        selections.append(FieldNode(
+            alias=NameNode(value=f"op{i}"),
+            name=field.name,
+            arguments=field.arguments,
+            directives=field.directives,
+            selection_set=field.selection_set,
+        ))
+    batch_documents[key] = DocumentNode(definitions=[OperationDefinitionNode(
+        operation=documents[0].definitions[0].operation,
+        variable_definitions=variables,
+        directives=[],
+        selection_set=SelectionSetNode(selections=selections),
+    )])
+    if len(batch_documents) > BATCH_DOCUMENTS:
+        batch_documents.popitem(last=False)
+    return batch_documents[key]
+
+
+async def sync_project(project_url, workspace, field, zh_query, gh_query, **args):
     org_name = project_url.split("orgs/")[1].split("/")[0]
     proj_num = project_url.split("projects/")[1].split("/")[0]
 
-    # owner = gh_query(gh_user)['viewer']
-    org = gh_query(gh_org, dict(login=org_name, number=int(proj_num)))
+    # None of these depend on each other so read them all at once.
+    # Items only need the fields to place them
+    fields_read = asyncio.ensure_future(read_fields(gh_query, org_name, int(proj_num)))
+    (proj, all_fields), items, workspaces = await asyncio.gather(
+        fields_read,
+        read_items(gh_query, org_name, int(proj_num), fields_read),
+        zh_query(zh_workspaces),
+    )
+    # The items are kept for the whole run.
+    # Stop the gc rescanning them every time responses pile up. Collect first so the
+    # garbage from reading isn't frozen with them
+    gc.collect()
+    gc.freeze()
+    try:
+        # map excludes
+        exclude = {}
+        for f, pat in (m.split(":") for m in args["exclude"]):
+            exclude.setdefault(f, []).append(pat)
+        del args["exclude"]
+        # one regex per field so each value is matched in a single pass
+        exclude = {
+            f: re.compile("|".join(fnmatch.translate(pat) for pat in pats))
+            for f, pats in exclude.items()
+        }
+
+        workspaces = {ws["name"]: ws for ws in workspaces["recentlyViewedWorkspaces"]["nodes"]}
+        if not workspace:
+            workspace = list(workspaces.keys())
+        workspace = [
+            w
+            for w in workspace
+            if not excluded(exclude, "Workspace", w)
+        ]
+
+        # Map src to tgt fields
+        fields = {}
+        all_fields["Text"] = TEXT
+        for fmapping in [default_mapping, field]:
+            tfields = {}
+            for mapping in fmapping:
+                src, tgt, *conv = mapping.split(":") if ":" in mapping else (mapping, mapping)
+                tfields.setdefault(src, []).append(
+                    (all_fields.get(tgt), conv[0] if conv else None)
+                )
+            fields.update(tfields)
+
+        # TODO: need a more general way to create fields, or get rid of the idea of creating fields
+        # TODO: problem with creating singleselect fields is there is no api to add extra options
+        # later
+        if "Workspace" in fields and fields["Workspace"] is None:
+            # grey = gh_query.__self__.schema.type_map['ProjectV2SingleSelectFieldOptionColor']
+            #     .values['GRAY']
+            options = [
+                dict(fuzzy_get(workspaces, name), description="", color="GRAY")
+                for name in workspace
+            ]
+            field = await gh_query(
+                gh_add_field, dict(name="Workspace", proj=proj["id"], options=options)
+            )
+            field["Workspace"] = fields["Workspace"] = field
+
+        # fields maps field name -> (from, to) -> count of values converted, for the summary
+        proj["_stats"] = stats = dict(removed=0, text=0, added=0, fields={})
+        seen = set()
+        last = {}
+        loader = IssueLoader(gh_query)
+        for name in workspace:
+            ws = fuzzy_get(workspaces, name)
+            stats['added'] += await sync_workspace(
+                ws, proj, fields, items, exclude, seen, last, zh_query, gh_query, loader, **args
+            )
+
+        # We need to set the body on any that we changed
+        print("Save text changes")
+        changed = [
+            item['content']
+            for item in items.values()
+            if item['content'] and '_deps' in item['content']
+        ]
+        # Only issues read from the project are missing their body. Get them all in one go.
+        missing = [gh_issue for gh_issue in changed if "body" not in gh_issue]
+        bodies = await send_batch(
+            gh_query,
+            [
+                (gh_get_issue, dict(zip(("owner", "repo", "number"), issue_key(c))))
+                for c in missing
+            ],
+        )
+        for gh_issue, res in zip(missing, bodies):
+            gh_issue["body"] = res["issueOrPullRequest"]["body"]
+        ops = []
+        for gh_issue in changed:
+            updated = set_text(gh_issue, deferred(ops))
+            print(f"- '{gh_issue['title']}' - {'UPDATED' if updated else 'SKIPPED'}")
+            stats['text'] += 1 if updated else 0
+        await send_batch(gh_query, ops)
+
+        # get list of all items in the current project so we can remove ones added by mistake if
+        # desired.
+        print()
+        print(f"Can remove - items no longer in input")
+        print("======================================")
+        # Compare by key only. Titles can change during the sync
+        extra = [key for key, item in items.items() if "id" in item and key not in seen]
+        ops = []
+        for key in extra:
+            item = items[key]
+            name = (item["content"] or {}).get("title")
+            if not key:
+                # no content to get a title from
+                print(f"- '{item['id']}' - NOT REMOVED - Draft Issue")
+            elif args["disable_remove"]:
+                print(f"- '{key[1]}':'{name}' - NOT REMOVED - --disable-remove=true")
+            else:
+                ops.append((gh_del_item, dict(proj=proj["id"], issue=item["id"])))
+                print(f"- '{key[1]}':'{name}' - REMOVED")
+                stats['removed'] += 1
+        if not extra:
+            print("- None")
+        await send_batch(gh_query, ops)
+        return stats
+    finally:
+        # let them go when used as a library
+        gc.unfreeze()
+
+
+async def read_fields(gh_query, org_name, proj_num):
+    """ the project and its fields by name """
+    # fields come with the project so it's one request
+    org = await gh_query(gh_org, dict(login=org_name, number=proj_num))
     proj = org["organization"]["projectV2"]
-    all_fields = {
-        f["name"]: f
-        for f in gh_query(gh_get_Fields, dict(proj=proj["id"]))["node"]["fields"]["nodes"]
-    }
+    all_fields = {f["name"]: f for f in proj["fields"]["nodes"]}
     all_fields['Position'] = dict(name="Position")
+    # index the choices up front so each item's lookups are a dict get
+    for f in all_fields.values():
+        if "options" in f:
+            field_options(f, "id")
+            field_options(f, "name")
+        elif "configuration" in f:
+            field_options(f, "id")
+            field_options(f, "title")
+    return proj, all_fields
+
+
+async def read_items(gh_query, org_name, proj_num, fields_read):
+    """ the project items by key. Each page is put on the cached board while the next is read """
+    # Get all the items so we can speed up queries and reduce updates.
+    # But don't get body yet due to rate limiting.
+    print("Reading Project", end="", flush=True)
+    items = {}
+    board = {}
+    async for item in iter_items(gh_query, org_name, proj_num):
+        _, all_fields = await fields_read
+        # Record order/after so we can see if it needs moving
+        cache_init_board(item, board=board)
+        cache_after_new(item, field_value(item, all_fields['Status']))
+        items[issue_key(item["content"])] = item
+    print()
+    return items
 
-    # Get proj states
 
-    # Get all the items so we can speed up queries and reduce updates. But don't get body yet due to rate limiting.
-    items = []
-    cursor = None
-    print("Reading Project", end="")
+async def iter_items(gh_query, org_name, proj_num, first=100):
+    """ yield the project items in order.
+    Github cursors are opaque so pages are read one after the other """
+    variables = dict(login=org_name, number=proj_num, cursor=None, first=first)
+    page = asyncio.ensure_future(gh_query(gh_proj_items, variables))
     while True:
-        res = gh_query(gh_proj_items, dict(login=org_name, number=int(proj_num), cursor=cursor))[
-            "organization"
-        ]["projectV2"]["items"]
-        items.extend(res["nodes"])
-        print(".", end="")
+        res = (await page)["organization"]["projectV2"]["items"]
+        if res["pageInfo"]["hasNextPage"]:
+            # start on the next page while this one is used
+            page = asyncio.ensure_future(
+                gh_query(gh_proj_items, dict(variables, cursor=res["pageInfo"]["endCursor"]))
+            )
+        print(".", end="", flush=True)
+        for item in res["nodes"]:
+            yield item
         if not res["pageInfo"]["hasNextPage"]:
             break
-        cursor = res["pageInfo"]["endCursor"]
-    print()
-
-    # Record order/after so we can see if it needs moving
-    board = {}
-    for i in items:
-        status = field_value(i, all_fields['Status'])
-        cache_init_board(i, board=board)
-        cache_after_new(i, status)
-    items = {issue_key(item["content"]): item for item in items}
-
-    # map excludes
-    exclude = {}
-    for f, pat in (m.split(":") for m in args["exclude"]):
-        exclude.setdefault(f, []).append(pat)
-    del args["exclude"]
-
-    workspaces = {
-        ws["name"]: ws for ws in zh_query(zh_workspaces)["recentlyViewedWorkspaces"]["nodes"]
-    }
-    if not workspace:
-        workspace = list(workspaces.keys())
-    workspace = [
-        w
-        for w in workspace
-        if not any(fnmatch.fnmatch(w, pat) for pat in exclude.get("Workspace", []))
-    ]
-
-    # Map src to tgt fields
-    fields = {}
-    all_fields["Text"] = TEXT
-    for fmapping in [default_mapping, field]:
-        tfields = {}
-        for mapping in fmapping:
-            src, tgt, *conv = mapping.split(":") if ":" in mapping else (mapping, mapping)
-            tfields.setdefault(src, []).append((all_fields.get(tgt), conv[0] if conv else None))
-        fields.update(tfields)
-
-    # TODO: need a more general way to create fields, or get rid of the idea of creating fields
-    # TODO: problem with creating singleselect fields is there is no api to add extra options later
-    if "Workspace" in fields and fields["Workspace"] is None:
-        # grey = gh_query.__self__.schema.type_map['ProjectV2SingleSelectFieldOptionColor'].values['GRAY']
-        options = [
-            dict(fuzzy_get(workspaces, name), description="", color="GRAY") for name in workspace
-        ]
-        field = gh_query(gh_add_field, dict(name="Workspace", proj=proj["id"], options=options))
-        field["Workspace"] = fields["Workspace"] = field
-
-    stats = dict(removed=0, text=0, added=0)
-    seen = {}
-    last = {}
-    for name in workspace:
-        ws = fuzzy_get(workspaces, name)
-        stats['added'] += sync_workspace(ws, proj, fields, items, exclude, seen, last, zh_query, gh_query, **args)
-
-    # We need to set the body on any that we changed
-    print("Save text changes")
-    for item in items.values():
-        if not item['content'] or '_deps' not in item['content']:
-            continue
-        updated = set_text(item['content'], gh_query)
-        print(f"- '{item['content']['title']}' - {'UPDATED' if updated else 'SKIPPED'}")
-        stats['text'] += 1 if updated else 0
-
-    # get list of all items in the current project so we can remove ones added by mistake if desired.
-    print()
-    print(f"Can remove - items no longer in input")
-    print("======================================")
-    all_items = set(
-        (r, i.get("content", {}).get("title"), i["id"]) for r, i in items.items() if "id" in i
-    )
-    added_items = set((r, i.get("content", {}).get("title"), i["id"]) for r, i in seen.items())
-    for repo, name, item in all_items - added_items:
-        if not repo:
-            print(f"- '{repo[0]}':'{name}' - NOT REMOVED - Draft Issue")
-        elif args["disable_remove"]:
-            print(f"- '{repo[0]}':'{name}' - NOT REMOVED - --disable-remove=true")
-        else:
-            gh_query(gh_del_item, dict(proj=proj["id"], issue=item))
-            print(f"- '{repo[0]}':'{name}' - REMOVED")
-            stats['removed'] += 1
-    else:
-        print("- None")
-    return stats
 
 
-def sync_workspace(ws, proj, fields, items, exclude, seen, last, zh_query, gh_query, **args):
+async def sync_workspace(
+    ws, proj, fields, items, exclude, seen, last, zh_query, gh_query, loader, **args
+):
     # TODO: we aren't syncing data on closed tickets that were part of the workspace,
     # - would be send these to a special closes status or just remove them from the project?
 
     added = 0
 
-    epics = {
-        e["issue"]["id"]: e
-        for e in zh_query(zh_get_epics, dict(workspaceId=ws["id"]))["workspace"]["epics"]["nodes"]
-    }
+    # None of these depend on each other so fetch them all at once
+    epics, dependencies = await asyncio.gather(
+        zh_query(zh_get_epics, dict(workspaceId=ws["id"])),
+        zh_query(zh_get_dep, dict(workspaceId=ws["id"])),
+    )
+    pipelines = [
+        p
+        for p in ws["pipelines"]
+        if not excluded(exclude, "Pipeline", p["name"])
+    ]
+    # supposed to include prs also even if linked but doesn't seem to.
+    results = iter(
+        await asyncio.gather(
+            *(
+                zh_query(query, dict(pipelineId=p["id"], workspaceId=ws["id"]))
+                for p in pipelines
+                for query in (zh_issues, zh_prs)
+            )
+        )
+    )
+    pipeline_issues = {p["id"]: (next(results), next(results)) for p in pipelines}
+
+    # Get everything not already in the project up front. The loader sends them in a few batches
+    await asyncio.gather(
+        *(
+            get_issue(loader, items, issue=issue)
+            for issues, prs in pipeline_issues.values()
+            for issue in issues["searchIssuesByPipeline"]["nodes"]
+            + prs["searchIssuesByPipeline"]["nodes"]
+        )
+    )
+
+    epics = {e["issue"]["id"]: e for e in epics["workspace"]["epics"]["nodes"]}
 
+    # blocking issues by id for each blocked issue, so repeats are dropped without scanning
     deps = {}
-    for i in zh_query(zh_get_dep, dict(workspaceId=ws["id"]))["workspace"]["issueDependencies"][
-        "nodes"
-    ]:
-        blocked = deps.setdefault(i["blockedIssue"]["id"], [])
-        if i["blockingIssue"] not in blocked:
-            blocked.append(i["blockingIssue"])
+    for i in dependencies["workspace"]["issueDependencies"]["nodes"]:
+        deps.setdefault(i["blockedIssue"]["id"], {})[i["blockingIssue"]["id"]] = i["blockingIssue"]
+
+    statuses = field_options(fields["Pipeline"][0][0], "name")
 
-    statuses = {opt["name"]: opt for opt in fields["Pipeline"][0][0]["options"]}
+    # Add the issues missing from the project for all pipelines together
+    # rather than one request each
+    new = {}
+    for issues, prs in pipeline_issues.values():
+        prs = {pr['id']: pr for pr in prs["searchIssuesByPipeline"]["nodes"]}
+        for issue in issues["searchIssuesByPipeline"]["nodes"] + list(prs.values()):
+            issue['connections'] = prs.get(issue['id'], {'connections': {}})['connections']
+            key = issue_key(issue)
+            gh_issue = items[key]["content"]
+            if (
+                "id" not in items[key]
+                and gh_issue["repository"]["archivedAt"] is None
+                and not zh_value(ws, issue, "Linked Issues", epics, deps)[0]
+            ):
+                new[key] = dict(proj=proj["id"], issue=gh_issue["id"])
+    new = dict(
+        zip(
+            new,
+            await send_batch(gh_query, [(gh_add_item, variables) for variables in new.values()]),
+        )
+    )
 
+    # Field updates don't depend on each other or the moves so send them in the background
+    tasks = []
     for pos, pipeline in enumerate(ws["pipelines"]):
-        # supposed to include prs also even if linked but doesn't seem to.
-        issues = zh_query(
-            zh_issues, dict(pipelineId=pipeline["id"], workspaceId=ws["id"])
-        )["searchIssuesByPipeline"]["nodes"]
-        prs = zh_query(
-            zh_prs, dict(pipelineId=pipeline["id"], workspaceId=ws["id"])
-        )["searchIssuesByPipeline"]["nodes"]
-        prs = {pr['id']: pr for pr in prs}
-
-        if any(fnmatch.fnmatch(pipeline["name"], drop_col) for drop_col in exclude.get("Pipeline", [])):
+        if pipeline["id"] not in pipeline_issues:
             print(f"Excluding Pipeline '{ws['name']}/{pipeline['name']}'")
             continue
+        issues, prs = pipeline_issues[pipeline["id"]]
+        issues = issues["searchIssuesByPipeline"]["nodes"]
+        prs = {pr['id']: pr for pr in prs["searchIssuesByPipeline"]["nodes"]}
 
         # add state if we don't have it. # TODO. no api for this yet. Have to create the whole field
         # for now we will just pick closest match
         status = fuzzy_get(statuses, pipeline["name"])
         print(f"Merging {ws['name']}/{pipeline['name']} -> {proj['title']}/{status['name']}")
+        # Moves are worked out once the whole pipeline is known so the output waits till then
+        start = last[status['id']]["id"] if last.get(status['id']) else None
+        order = []
+        report = []
+        # Collect the pipeline's field updates so they go in as few requests as possible
+        ops = []
+        gh_mutate = deferred(ops)
         for issue in issues + list(prs.values()):
             issue["Pipeline"] = pipeline["name"]
             changes = []
-            issue['connections'] = prs.get(issue['id'], {'connections': {}})['connections']
+            report.append((issue, changes))
             key = issue_key(issue)
-            if key in items:
-                item = items[key]
-                gh_issue = item["content"]
-            else:
-                gh_issue = get_issue(gh_query, items, issue=issue)
-                item = None
+            gh_issue = await get_issue(loader, items, issue=issue)
+            # items from get_issue with no id aren't in the project yet
+            item = items[key] if "id" in items[key] else None
 
             if gh_issue["repository"]["archivedAt"] is not None:
                 # handle if the issue is in archived repo
-                print(
-                    f"- '{issue['repository']['name']}':'{issue['title']}' - SKIP - Archived Repo"
-                )
+                changes += ["SKIP - Archived Repo"]
                 continue
-            elif zh_value(ws, issue, "Linked Issues", epics, deps, zh_query)[0]:
+            elif zh_value(ws, issue, "Linked Issues", epics, deps)[0]:
                 # Any PR that is linked we don't want to appear on the board
                 # If linked correctly then it will appear be merged in with the issue
                 # If not gh linked (e.g. not main branch PR), then we want to hide it since it's not on ZH Board
                 # TODO: this does mean any fields set on the item will not be transfered
                 # - linked PR won't appear in the board but does it appear in other views if added?
                 # - to fix we'd have to only skip PR's that we can't link.
-                print(
-                    f"- '{issue['repository']['name']}':'{issue['title']}' - SKIP - don't add linked PRs"
-                )
+                report.insert(-1, (issue, ["SKIP - don't add linked PRs"]))
                 item = {}  # We still want to link it to the Issue and set non project stuff
             elif item is None:
-                # add issue if not there
-                item = gh_query(gh_add_item, dict(proj=proj["id"], issue=gh_issue["id"]))[
-                    "addProjectV2ItemById"
-                ]["item"]
+                # added above
+                item = new[key]["item"]
                 items[key] = item
                 item["content"] = gh_issue  # Don't need to get this again via the query
                 # Need to get the board from somewhere. TODO: switch board and last
@@ -270,42 +737,35 @@ def sync_workspace(ws, proj, fields, items, exclude, seen, last, zh_query, gh_qu
                 changes += ["ADD*"]
                 added += 1
             if key in seen:
-                print(f"- '{issue['repository']['name']}':'{issue['title']}' - SKIP - Added already")
+                changes += ["SKIP - Added already"]
                 continue
             elif item:
-                seen[key] = item
+                seen.add(key)
 
             # # TODO: can we reproduce the history?
 
-            changes = []
+            # Work out the value wanted for each field first then only update those that differ
+            desired = {}
+            move = False
             for src, dst in fields.items():
                 for field, conv in dst:
                     res = []
-                    closest = conv.lower() if conv and conv.lower() in ['closest', 'exact', 'scale'] else 'closest'
+                    closest = (
+                        conv.lower()
+                        if conv and conv.lower() in ['closest', 'exact', 'scale']
+                        else None
+                    )
                     if src == 'Position':
                         value, options = last[status['id']]["id"] if last.get(status['id']) else None, []
                     else:
-                        value, options = zh_value(ws, issue, src, epics, deps, zh_query)
+                        value, options = zh_value(ws, issue, src, epics, deps)
                     if item and field and field.get('name') == 'Position':
-                        # set order/position
-                        # TODO: there is a way with less moves
-                        if cache_is_after(item, value):
-                            changes += []
-                        else:
-                            gh_query(
-                                gh_set_order,
-                                dict(
-                                    proj=proj["id"],
-                                    item=item["id"],
-                                    after=value,
-                                ),
-                            )
-                            changes += ["POS*"] if value else ["TOP*"]
-                            cache_after(item, value)             
+                        # set order/position once the status is known
+                        move, after = True, value
                     elif not value or not field:
                         # TODO: we should unset the field?
                         continue
-                    elif type(value) == list:
+                    elif isinstance(value, list):
                         # List of issues. Currently no support for multi-select fields
                         if field == TEXT:
                             text = ""
@@ -314,15 +774,31 @@ def sync_workspace(ws, proj, fields, items, exclude, seen, last, zh_query, gh_qu
                                 text += f"- [ ] {fixes}{shorturl(sub['url'])}\n"
                             res.append(add_text(gh_issue, src, text, proj))
                         elif field["name"] == "Linked pull requests":
-                            res.extend(update_linked_prs(item, gh_issue, field, value, proj))
+                            res.extend(
+                                await update_linked_prs(
+                                    item, gh_issue, field, value, proj, items, loader
+                                )
+                            )
                         else:
                             # only other way to record this is by
                             # setting a field value on the linked item
-                            for sub in value:
-                                sub = get_issue(gh_query, items, sub["url"])
+                            subs = await asyncio.gather(
+                                *(get_issue(loader, items, sub["url"]) for sub in value)
+                            )
+                            for sub in subs:
+                                sub = items[issue_key(sub)]
+                                if "id" not in sub:
+                                    # not in the project so no fields to set
+                                    continue
                                 res.append(
                                     set_field(
-                                        proj, sub, field, gh_issue["title"], gh_query, closest, options
+                                        proj,
+                                        sub,
+                                        field,
+                                        gh_issue["title"],
+                                        gh_mutate,
+                                        closest,
+                                        options,
                                     )
                                 )
                     elif field == TEXT:
@@ -334,64 +810,137 @@ def sync_workspace(ws, proj, fields, items, exclude, seen, last, zh_query, gh_qu
                         # TODO: if it's a PR that ZH thinks is linked but github doesn't like the link (ie not PR to main). 
                         # Then maybe reset status to None so doesn't appear in the project?
                         # or if that doesn't work, never add it
-                        res.append(set_field(proj, item, field, value, gh_query, closest, options))
+                        desired[field["id"]] = (
+                            field,
+                            option_value(proj, field, value, closest, options),
+                        )
                     if res:
                         changes += [f"{field.get('name', src)[:3].upper()}{'*' if any(res) else ''}"]
+            if desired:
+                changed = set_fields(proj, item, desired, gh_mutate)
+                changes += [
+                    f"{field['name'][:3].upper()}{'*' if fid in changed else ''}"
+                    for fid, (field, _) in desired.items()
+                ]
+            if move:
+                order.append((item, changes))
             if item:
                 last[status['id']] = item
-
-            print(f"- '{issue['repository']['name']}':'{issue['title']}' - {', '.join(changes)}")
+        tasks.append(asyncio.ensure_future(send_batch(gh_query, ops)))
+
+        moves = []
+        for item, changes, after in cache_out_of_order(order, start, status['id']):
+            moves.append((gh_set_order, dict(proj=proj["id"], item=item["id"], after=after)))
+            changes += ["POS*"] if after else ["TOP*"]
+            cache_after(item, after)
+        # Position depends on the items before it so the moves have to be applied in order
+        await send_batch(gh_query, moves, ordered=True)
+        # one write per pipeline rather than per issue
+        sys.stdout.write(
+            "".join(
+                f"- '{issue['repository']['name']}':'{issue['title']}' - {', '.join(changes)}\n"
+                for issue, changes in report
+            )
+        )
+    await asyncio.gather(*tasks)
     return added
 
 
-def fuzzy_get(dct, key, closest=True, globs=False):
+def excluded(exclude, field, value):
+    """ True if value matches any of the exclude patterns given for field """
+    return field in exclude and exclude[field].match(value) is not None
+
+
+def fuzzy_get(dct, key, closest=True):
     """
     return the value whose key is the closest
 
       >>> fuzzy_get({"foo":1, "bah":2}, "fo")
       1
     """
-    if type(dct) == list:
+    if isinstance(dct, list):
         dct = {i: i for i in dct}
-    if globs:
-        res = next((fnmatch.fnmatch(name, key) for name in dct.keys()), None)
-        if res is not None:
-            dct[res]
-    if closest:
-        res = next(iter(difflib.get_close_matches(key, dct.keys(), 1, 0)))
-    else:
+    if key in dct or not closest:
+        # Nearly always an exact match so skip matching
         res = key
+    else:
+        res = closest_match(tuple(dct.keys()), key)
     return dct.get(res, None)
 
 
-def get_issue(gh_query, items, url=None, owner=None, repo=None, number=None, issue=None):
+@functools.lru_cache(maxsize=4096)
+def closest_match(keys, key):
+    """ cached as the same few names get matched against the same options for every item """
+    if isinstance(key, str):
+        # Next most likely is just a difference in case
+        res = next((k for k in keys if isinstance(k, str) and k.lower() == key.lower()), None)
+        if res is not None:
+            return res
+    if rapidfuzz is not None:
+        match = rapidfuzz.process.extractOne(key, keys, scorer=rapidfuzz.fuzz.WRatio)
+        return match[0] if match else None
+    return next(iter(difflib.get_close_matches(key, keys, 1, 0)), None)
+
+
+async def get_issue(loader, items, url=None, owner=None, repo=None, number=None, issue=None):
     if url is not None:
-        prot, _, gh, owner, repo, _type, number = url.split("/")[:7]
+        owner, repo, number = ISSUE_URL.match(url).groups()
     elif issue is not None:
         number = issue["number"]
         repo = issue["repository"]["name"]
         owner = issue["repository"]["owner"]["login"]
+    # Same key as issue_key so url lookups hit items already loaded
+    number = int(number)
 
     if (owner, repo, number) in items:
         return items[(owner, repo, number)]["content"]
 
-    issue = gh_query(
-        gh_get_issue,
-        dict(
-            number=int(number),
-            repo=repo,
-            owner=owner,
-        ),
-    )[
-        "repository"
-    ]["issueOrPullRequest"]
+    issue = await loader.load(owner, repo, number)
 
     # put in a fake item for now
-    items[(owner, repo, number)] = dict(content=issue)
-    return issue
+    items.setdefault((owner, repo, number), dict(content=issue))
+    return items[(owner, repo, number)]["content"]
+
+
+class IssueLoader:
+    """ issues requested in the same tick are fetched together as one aliased query """
+
+    def __init__(self, gh_query):
+        self.gh_query = gh_query
+        self.loaded = {}
+        self.pending = {}
+        self.flushing = None
+
+    def load(self, owner, repo, number):
+        key = (owner, repo, number)
+        if key not in self.loaded:
+            if not self.pending:
+                self.flushing = asyncio.ensure_future(self.flush())
+            self.loaded[key] = self.pending[key] = asyncio.get_running_loop().create_future()
+        return self.loaded[key]
+
+    async def flush(self):
+        # let everyone else waiting to run ask for their issues first
+        await asyncio.sleep(0)
+        pending, self.pending = self.pending, {}
+        try:
+            res = await send_batch(
+                self.gh_query,
+                [
+                    (gh_get_issue, dict(owner=owner, repo=repo, number=number))
+                    for owner, repo, number in pending
+                ],
+            )
+        except Exception as e:
+            for key, future in pending.items():
+                del self.loaded[key]  # so it can be retried
+                future.set_exception(e)
+        else:
+            for future, r in zip(pending.values(), res):
+                future.set_result(r["issueOrPullRequest"])
 
 
-def zh_value(ws, issue, name, epics, deps, zh_query):
+def zh_value(ws, issue, name, epics, deps):
     if name == "Workspace":
         # put in original workspace name as custom field
         # - we can always get rid of it later
@@ -401,29 +950,26 @@ def zh_value(ws, issue, name, epics, deps, zh_query):
     elif name == "Pipeline":
         return issue["Pipeline"], [p["name"] for p in ws["pipelines"]]
     elif name == "Estimate":
-        story_points = [40, 21, 13, 8, 5, 3, 2, 1]
         # TODO: can't find in graph api how to get this scale. or find a better hack?
         # - could get all items and find range that way?
 
         # if aren't using this scale then we will do a hack and just insert the new value in so it works out
         value = issue["estimate"]["value"] if issue["estimate"] else None
-        if value is not None and value not in story_points:
-            story_points = list(sorted(story_points + [value], reverse=True))
-        return value, story_points
+        if value is not None and value not in STORY_POINTS:
+            return value, sorted(STORY_POINTS + (value,), reverse=True)
+        return value, STORY_POINTS
 
     elif name == "Priority":
         return issue["pipelineIssue"]["priority"]["name"] if issue["pipelineIssue"][
             "priority"
         ] else None, ["Normal", "High Priority"]
-    elif name == "Sprints":
+    elif name in ("Sprint", "Sprints"):
         # Can't really set multiple iterations so just use latest
-        return issue["sprints"]["nodes"][-1], []
-    # Reading the history turns out to be unreliable. Instead we will set this on the linked PRs.
-    # elif name == "PR":
-    #     urls = zh_history_values(issue, "issue.connect_issue_to_pr", "issue.disconnect_issue_from_pr")
-    #     return [u for u in urls if "/oull/" in u], []
+        sprints = issue["sprints"]["nodes"]
+        return sprints[-1] if sprints else None, []
+    # Reading the PR links from the history turns out to be unreliable. Instead we will set this on
+    # the linked PRs.
     elif name == "Linked Issues" and issue['pullRequest']:
-        # urls = zh_history_values(issue, "issue.connect_issue_to_pr", "issue.disconnect_issue_from_pr")
         # Issue is a PR and links back to a ticket/issue
         return [dict(url="https://github.com/{}/{}/issue/{}".format(*issue_key(linked))) for linked in issue["connections"]["nodes"]], []
     elif name == "Epic":
@@ -433,74 +979,97 @@ def zh_value(ws, issue, name, epics, deps, zh_query):
         epic = epics[issue["id"]]
         # # TODO: This info won't get transfered if the epic itsself has been closed.
         # - might need an extra step to transfer information for closed tickets that were part of the workspace?
-        for subissue in zh_query(
-            zh_epic_issues, dict(zenhubEpicId=epic["id"], workspaceId=ws["id"])
-        )["node"]["childIssues"]["nodes"]:
+        for subissue in epic["childIssues"]["nodes"]:
             urls.append(dict(url=subissue["htmlUrl"]))
         return urls, []
     elif name == "Blocked By" and issue["id"] in deps:
-        return [dict(url=i["htmlUrl"]) for i in deps.get(issue["id"], [])], []
+        return [dict(url=i["htmlUrl"]) for i in deps[issue["id"]].values()], []
     else:
         return (None, [])
 
 
-def zh_history_values(issue, add_event, rm_event):
-    # Use the history in ZH to work out the value of some fields there is no api for
-    urls = []
-    for htype, hist in [
-        (hist["type"], hist["data"])
-        for hist in issue["timelineItems"]["nodes"]
-        if hist["type"] in [add_event, rm_event]
-    ]:
-        if "pull_request" in hist:
-            itype, owner, repo, number = (
-                "pull",
-                hist["pull_request_organization"]["login"],
-                hist["pull_request_repository"]["name"],
-                hist["pull_request"]["number"],
-            )
-        else:
-            itype, owner, repo, number = (
-                "issue",
-                hist["issue_organization"]["login"],
-                hist["issue_repository"]["name"],
-                hist["issue"]["number"],
+def field_value(item, field):
+    if "_values" not in item:
+        # index the values by field id the first time so we don't scan them for every field
+        item["_values"] = {
+            n["field"]["id"]: next(
+                (
+                    n[at]
+                    for at in ["text", "number", "pullRequests", "optionId", "iterationId"]
+                    if at in n
+                ),
+                None,
             )
-        url = f"https://github.com/{owner}/{repo}/{itype}/{number}"
-        if htype == add_event:
-            urls.append(dict(url=url))
-        else:
-            urls.remove(dict(url=url))
-    return urls
-    
+            for n in item["fieldValues"]["nodes"]
+            if n.get("field", {}).get("id")
+        }
+    return item["_values"].get(field["id"])
 
-def field_value(item, field):
-    value = next(
-        (n for n in item["fieldValues"]["nodes"] if n.get("field", {}).get("id") == field["id"]),
-        None,
-    )
-    if value is None:
-        return None
-    else:
-        return next(
-            value[at]
-            for at in ["text", "number", "pullRequests", "optionId", "users"]
-            if at in value
-        )
 
+@dataclasses.dataclass
+class BoardColumn:
+    """ item ids of a status column in order, with the position of each id for quick lookups """
 
-def cache_is_after(item, after):
-    """ True if the item is already after "after" in the target board """
-    board, status = item['_board']
-    col = board[status]
-    i = col.index(item)
-    i_after = next((pos for pos, i in enumerate(col) if i['id'] == after)) if after else -1
-    return i == i_after + 1
+    ids: list = dataclasses.field(default_factory=list)
+    pos: dict = dataclasses.field(default_factory=dict)
+
+    def insert(self, index, item_id):
+        self.ids.insert(index, item_id)
+        self.reindex(index)
+
+    def remove(self, item_id):
+        index = self.pos.pop(item_id)
+        del self.ids[index]
+        self.reindex(index)
 
+    def reindex(self, start):
+        # only the items after the change have moved
+        for i in range(start, len(self.ids)):
+            self.pos[self.ids[i]] = i
 
-def cache_init_board(new_item, item=None, board={}):
+
+def cache_out_of_order(order, after, status):
+    """
+    the (item, changes, after) moves needed so the items in order follow "after" in the status col
+    of the target board. Items already in the right order relative to each other are left where
+    they are
+
+      >>> board, items = {}, {i: {"id": i} for i in "xaybc"}
+      >>> for item in items.values():
+      ...     cache_init_board(item, board=board)
+      ...     cache_after_new(item, "Todo")
+      >>> order = [(items[i], []) for i in "acb"]
+      >>> [(item["id"], after) for item, _, after in cache_out_of_order(order, "x", "Todo")]
+      [('c', 'a')]
+    """
+    if not order:
+        return []
+    board, _ = order[0][0]['_board']
+    col = board.get(status, BoardColumn())
+    wanted = ([after] if after else []) + [item['id'] for item, _ in order]
+    ids = set(wanted)
+    # only whats below after can already be in place
+    below = col.ids[col.pos[after] + 1 :] if after in col.pos else col.ids
+    current = ([after] if after else []) + [i for i in below if i in ids and i != after]
+    keep = set()
+    for a, b, size in difflib.SequenceMatcher(
+        None, current, wanted, autojunk=False
+    ).get_matching_blocks():
+        keep.update(wanted[b : b + size])
+    moves = []
+    for item, changes in order:
+        if item['id'] not in keep:
+            moves.append((item, changes, after))
+        after = item['id']
+    return moves
+
+
+def cache_init_board(new_item, item=None, board=None):
     """" set the shared board state on the item. Set status to None ready to put onto the cached board """
-    board, _ = item['_board'] if item is not None else (board, None)
+    if item is not None:
+        board, _ = item['_board']
+    elif board is None:
+        board = {}
     new_item['_board'] = (board, None)  # actual location will be set later
 
 
@@ -508,65 +1077,116 @@ def cache_after(item, after):
     """ move item to after "after" in the target board cache """
     board, status = item['_board']
     col = board[status]
-    col.remove(item)
-    i_after = next((pos for pos, i in enumerate(col) if i['id'] == after)) if after else -1
-    col.insert(i_after + 1, item)
+    col.remove(item['id'])
+    i_after = col.pos[after] if after else -1
+    col.insert(i_after + 1, item['id'])
 
 
 def cache_after_new(item, new_status):
     """ put item at the bottom of the new_status col on the cached target board """
     board, status = item['_board']
-    old_col = board.get(status, [])
-    if item in old_col:
-        old_col.remove(item)
-    board.setdefault(new_status, []).append(item)
+    old_col = board.get(status)
+    if old_col is not None and item['id'] in old_col.pos:
+        old_col.remove(item['id'])
+    col = board.setdefault(new_status, BoardColumn())
+    col.insert(len(col.ids), item['id'])
     item['_board'] = (board, new_status)
 
 
-field_stats = {}
+def field_options(field, by):
+    """ options (or iterations) of the field keyed by "id", "name" or "title".
+    Built once per field """
+    index = field.setdefault("_options", {})
+    if by not in index:
+        if "options" in field:
+            options = field["options"]
+        else:
+            # past sprints can only match iterations that are over
+            config = field["configuration"]
+            options = config["iterations"] + (config.get("completedIterations") or [])
+        index[by] = {opt[by]: opt for opt in options}
+    return index[by]
+
 
+def set_field(proj, item, field, value, gh_query, match=None, options=()):
+    value = option_value(proj, field, value, match, options)
+    return bool(set_fields(proj, item, {field["id"]: (field, value)}, gh_query))
 
-def set_field(proj, item, field, value, gh_query, match="closest", options=[]):
+
+def option_value(proj, field, value, match=None, options=()):
+    """ the value to set on field as the field's type.
+    For select fields this is the id of the matching option """
     orig_value = value
+    if match is None:
+        # A sprint given the nearest iteration would be wrong more often than not
+        match = "exact" if field.get("dataType") == "ITERATION" else "closest"
+    if field.get("dataType") == "TEXT":
+        return str(value)
+    elif field.get("dataType") == "NUMBER":
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    elif field.get("dataType") == "ITERATION":
+        # iterations have no options, match on the title instead. Sprints come as a dict
+        title = value["name"] if isinstance(value, dict) else str(value)
+        iteration = fuzzy_get(field_options(field, "title"), title, closest=match == 'closest')
+        return iteration["id"] if iteration else None
     if match == "scale" and "options" in field and options:
         # work out closest by rank
         pos = options.index(value)
         new_opt = field["options"]
         value = new_opt[round(pos / len(options) * len(new_opt))]["id"]
-    elif "options" in field and value not in {opt["id"] for opt in field["options"]}:
+    elif "options" in field and value not in field_options(field, "id"):
         # Get closest match
-        value = fuzzy_get({opt["name"]: opt for opt in field["options"]}, value, closest=match == 'closest')
+        value = fuzzy_get(field_options(field, "name"), value, closest=match == 'closest')
         value = value["id"] if value else None
     if "options" in field:
-        vname = next((f['name'] for f in field['options'] if f['id'] == value), None)
-        mapping = field_stats.setdefault(field['name'], {})
+        vname = (
+            field_options(field, "id")[value]["name"]
+            if value in field_options(field, "id")
+            else None
+        )
+        mapping = proj["_stats"]["fields"].setdefault(field['name'], {})
         mapping.setdefault((orig_value, vname), 0)
         mapping[(orig_value, vname)] += 1
-    if field_value(item, field) == value:
-        return False
-    elif value is None:
-        gh_query(gh_del_value, dict(proj=proj["id"], item=item["id"], field=field["id"]))
-    else:
-        query = (
-            gh_set_option
-            if "options" in field
-            else gh_set_number
-            if type(value) == int or float
-            else gh_set_value
-        )
+    return value
+
+
+def set_fields(proj, item, desired, gh_query):
+    """ update the fields in desired {field id: (field, value)} that differ from the item.
+    Returns ids of those changed """
+    # Other kinds of field (title, date, assignees...) can't be set this way
+    changed = [
+        fid
+        for fid, (field, value) in desired.items()
+        if field.get("dataType") in FIELD_SETTERS
+        and field_value(item, field) != value
+        # a sprint with no matching iteration leaves the iteration as it is rather than clearing it
+        and (value is not None or field["dataType"] != "ITERATION")
+    ]
+    for fid in changed:
+        field, value = desired[fid]
+        # remember what we've sent so setting it again is a no-op
+        item["_values"][fid] = value
+        if value is None:
+            gh_query(gh_del_value, dict(proj=proj["id"], item=item["id"], field=field["id"]))
+            continue
+        query = FIELD_SETTERS[field["dataType"]]
         gh_query(query, dict(proj=proj["id"], item=item["id"], field=field["id"], value=value))
         if field["name"] == 'Status':
             # need to keep track of positin
             cache_after_new(item, value)
-    return True
+    return changed
 
 
-def update_linked_prs(item, gh_issue, field, value, proj):
+async def update_linked_prs(item, gh_issue, field, value, proj, items, loader):
     res = []
     # We can't set this directly. Only by modifying each PR text.
     # # TODO: there is special linked PR field but can't set it? https://github.com/orgs/community/discussions/40860
     # # seems like it only lets you create a branch, not link a PR? do via discussion? or work out how UI lets you set it?
     # # gh_query(gh_set_value, dict(proj=proj, item=item['id'], field=fields['Linked pull requests']['id'], value=pr['url']))
+    urls = []
     for sub in value:
         # Check not already linked
         linked = field_value(item, field)
@@ -580,8 +1200,9 @@ def update_linked_prs(item, gh_issue, field, value, proj):
                 f"- '{gh_issue['title']}' - SKIP PR update on '{sub['url']}'"
             )
             continue
-        # TODO: this will only work if the base is the main branch. Linked field won't get updated
-        sub = get_issue(gh_query, items, sub["url"])
+        urls.append(sub["url"])
+    # TODO: this will only work if the base is the main branch. Linked field won't get updated
+    for sub in await asyncio.gather(*(get_issue(loader, items, url) for url in urls)):
         res.append(
             add_text(
                 sub,
@@ -624,19 +1245,20 @@ def add_text(gh_issue, name, text, proj):
 def set_text(gh_issue, gh_query, heading="Dependencies"):
     if "_deps" not in gh_issue:
         return False
-    old_body = get_issue(gh_query, {}, gh_issue['url'])["body"]
+    old_body = gh_issue["body"]
     body, *rest = old_body.split(f"\r\n# {heading}\r\n", 1)
     rest = "" if not rest else rest[0]
     if "\n# " in rest:
         rest = rest[rest.find("\r\n# ") :]
     else:
         rest = ""
-    text = ""
+    # joined once at the end rather than growing the string per line
+    parts = []
     for title, lines in gh_issue.get("_deps", {}).items():
         if lines:
-            text += f"\n## {title}\n"
-        for line in lines:
-            text += f"\n{line}"
+            parts.append(f"\n## {title}\n")
+        parts.extend(f"\n{line}" for line in lines)
+    text = "".join(parts)
     if text:
         text = (f"\n# {heading}\n" + text).replace("\n", "\r\n")
     new_body = body + text + rest
@@ -654,28 +1276,24 @@ def set_text(gh_issue, gh_query, heading="Dependencies"):
 
 def issue_key(issue):
     # Can be a DRAFT_ISSUE which has no content
-    return (issue["repository"]["owner"]["login"], issue["repository"]["name"], issue["number"]) if issue else None
+    if not issue:
+        return None
+    # the same issue dicts are looked up many times so keep the key on them
+    if "_key" not in issue:
+        issue["_key"] = (
+            issue["repository"]["owner"]["login"],
+            issue["repository"]["name"],
+            issue["number"],
+        )
+    return issue["_key"]
 
 
+@functools.lru_cache(maxsize=4096)
 def shorturl(url, base=None):
-    return url.replace("https://github.com/", "").replace("/issue/", "#").replace("/pull/", "#")
+    # the same issues get linked from many places
+    return ISSUE_URL.sub(r"\1/\2#\3", url)
 
 
-zh_workspace = gql(
-    """
-query ($workspaceId: ID!) {
-    workspace(workspaceId: $workspaceId) {
-        id
-        displayName
-        pipelines {
-            id
-            name
-        }
-    }
-}
-"""
-)
-
 zh_workspaces = gql(
     """
 query RecentlyViewedWorkspaces {
@@ -701,31 +1319,19 @@ query ($pipelineId: ID!, $workspaceId:ID!) {
         nodes {
             id
             title
-            ghId
             number
             pullRequest
             pipelineIssue(workspaceId: $workspaceId) {
               priority {
                 id
                 name
-                color
-              }
-            }
-            timelineItems(first: 50) {
-              nodes {
-                type: key
-                id
-                data
-                createdAt
               }
             }
             repository {
                 id
-                ghId
                 name
                 owner {
                   id
-                  ghId
                   login
                 }
             }
@@ -751,23 +1357,19 @@ query ($pipelineId: ID!, $workspaceId:ID!) {
         nodes {
             id
             title
-            ghId
             number
             pullRequest
             pipelineIssue(workspaceId: $workspaceId) {
               priority {
                 id
                 name
-                color
               }
             }
             repository {
                 id
-                ghId
                 name
                 owner {
                   id
-                  ghId
                   login
                 }
             }
@@ -784,15 +1386,12 @@ query ($pipelineId: ID!, $workspaceId:ID!) {
               nodes {
                 id
                 title
-                ghId
                 number
                 repository {
                     id
-                    ghId
                     name
                     owner {
                       id
-                      ghId
                       login
                     }
                 }
@@ -824,6 +1423,18 @@ zh_get_epics = gql(
                 name
               }
             }
+            childIssues {
+              nodes {
+                id
+                title
+                number
+                htmlUrl
+                repository {
+                  id
+                  name
+                }
+              }
+            }
           }
         }
       }
@@ -832,55 +1443,18 @@ zh_get_epics = gql(
 )
 
 
-zh_epic_issues = gql(
-    """
-query Issues($zenhubEpicId: ID!) {
-      node(id: $zenhubEpicId) {
-        ... on Epic {
-          childIssues {
-              nodes { 
-                     id 
-                     title 
-                     number
-                     htmlUrl
-                     repository {
-                        id
-                        name
-                      }
-                     } 
-          } 
-        } 
-      } 
-}
-"""
-)
-
-
 zh_get_dep = gql(
     """
     query getWorkspaceDependencies($workspaceId: ID!) {
       workspace(id: $workspaceId) {
         issueDependencies(first: 50) {
           nodes {
-            id
-            updatedAt
             blockedIssue {
               id
-              number
-              htmlUrl
-              repository {
-                id
-                ghId
-              }
             }
             blockingIssue {
               id
-              number
               htmlUrl
-              repository {
-                id
-                ghId
-              }
             }
           }
         }
@@ -890,70 +1464,6 @@ zh_get_dep = gql(
 )
 
 
-gh_add_column = gql(
-    """
-    mutation ($name: String!, $projectId: ID!) {
-        addProjectColumn(input: {
-            name: $name, projectId: $projectId
-        }) {
-            columnEdge
-        }
-    }
-"""
-)
-
-gh_get_states = gql(
-    """
-  mutation($proj:String, $item:String, $field:String, $option:String ) {
-    updateProjectV2ItemFieldValue(
-      input: {
-        projectId: $proj
-        itemId: $item
-        fieldId: $field
-        value: { 
-          singleSelectOptionId: $option        
-        }
-      }
-    ) {
-      projectV2Item {
-        id
-      }
-    }
-  }
-                    """
-)
-
-gh_add_project = gql(
-    """
-mutation ($ownerId: ID!, $repositoryId: ID!, $teamId: ID!, $title: String!) {
-    createProjectV2(input: {ownerId: $ownerId, repositoryId: $repositoryId, teamId: $teamId, title: $title}) {
-        projectV2 {
-            number
-            resourcePath
-            url
-        }
-    }
-}
-"""
-)
-
-gh_user = gql(
-    """
-{
-  viewer {
-    login
-    id
-  }
-  rateLimit {
-    limit
-    cost
-    remaining
-    resetAt
-  }
-}
-"""
-)
-
 gh_org = gql(
     """
   query($login:String!, $number:Int!) {
@@ -969,16 +1479,39 @@ gh_org = gql(
             login
           }
         }
-        teams(first:100) { 
+        fields(first: 20) {
           nodes {
-            id
-          }
-        }
-        creator { login }
-        public
-        repositories(first:100) {
-          nodes {
-            id
+            ... on ProjectV2Field {
+              id
+              name
+              dataType
+            }
+            ... on ProjectV2IterationField {
+              id
+              name
+              dataType
+              configuration {
+                iterations {
+                  startDate
+                  id
+                  title
+                }
+                completedIterations {
+                  startDate
+                  id
+                  title
+                }
+              }
+            }
+            ... on ProjectV2SingleSelectField {
+              id
+              name
+              dataType
+              options {
+                id
+                name
+              }
+            }
           }
         }
       } 
@@ -990,10 +1523,10 @@ gh_org = gql(
 
 gh_proj_items = gql(
     """
-  query($login:String!, $number:Int!, $cursor:String) {
+  query($login:String!, $number:Int!, $cursor:String, $first:Int!) {
     organization(login:$login) {
       projectV2(number: $number) {
-        items(first:100, after:$cursor, orderBy: {field: POSITION, direction: ASC}) {
+        items(first:$first, after:$cursor, orderBy: {field: POSITION, direction: ASC}) {
           pageInfo {
               hasNextPage
               endCursor
@@ -1016,19 +1549,18 @@ gh_proj_items = gql(
                   repository {id name archivedAt owner{login }}
                 }
             }
-            databaseId
             fieldValues(first:100) {
               nodes {
                 ... on ProjectV2ItemFieldValueCommon { field {... on ProjectV2FieldCommon { id }} }
                 ... on ProjectV2ItemFieldSingleSelectValue { optionId  }
                 ... on ProjectV2ItemFieldTextValue { text  }
-                ... on ProjectV2ItemFieldUserValue { users(first:10) { nodes { login }} field {... on Node { id } } }
                 ... on ProjectV2ItemFieldNumberValue { number }
-                ... on ProjectV2ItemFieldPullRequestValue { pullRequests(first:10) { nodes { id url }} field {... on Node { id } } }
-                ... on ProjectV2ItemFieldDateValue { date }
+                ... on ProjectV2ItemFieldIterationValue { iterationId }
+                ... on ProjectV2ItemFieldPullRequestValue {
+                  pullRequests(first:10) { nodes { url }} field {... on Node { id } }
+                }
               }
             }
-            type
           }
         }
       } 
@@ -1085,8 +1617,6 @@ query($repo:String!, $owner:String!, $number:Int!) {
           number
           body
           repository {id name archivedAt owner{login }}
-          projectsV2(first:100) { nodes { id }
-          }
         }
         ... on PullRequest {
           title
@@ -1095,8 +1625,6 @@ query($repo:String!, $owner:String!, $number:Int!) {
           number
           body        
           repository {id name archivedAt owner{login }}
-          projectsV2(first:100) { nodes { id }
-          }
         }
       }
   }
@@ -1104,22 +1632,6 @@ query($repo:String!, $owner:String!, $number:Int!) {
 """
 )
 
-gh_get_pr = gql(
-    """
-query($repo:String!, $owner:String!, $number:Int!) {
-  repository(name:$repo, owner:$owner) {
-      pullRequest(number: $number) {
-          title
-          url
-          id
-          number
-          body
-        }
-  }
-}
-"""
-)
-
 gh_add_field = gql(
     """
 mutation($proj:ID!, $name:String!, $options:[ProjectV2SingleSelectFieldOptionInput!]) {
@@ -1135,6 +1647,7 @@ mutation($proj:ID!, $name:String!, $options:[ProjectV2SingleSelectFieldOptionInp
                     ... on ProjectV2SingleSelectField {
                       id
                       name
+                      dataType
                       options {
                         id
                         name
@@ -1146,44 +1659,6 @@ mutation($proj:ID!, $name:String!, $options:[ProjectV2SingleSelectFieldOptionInp
 """
 )
 
-gh_get_Fields = gql(
-    """
-  query($proj:ID!){
-  node(id: $proj) {
-    ... on ProjectV2 {
-      fields(first: 20) {
-        nodes {
-          ... on ProjectV2Field {
-            id
-            name
-          }
-          ... on ProjectV2IterationField {
-            id
-            name
-            configuration {
-              iterations {
-                startDate
-                id
-              }
-            }
-          }
-          ... on ProjectV2SingleSelectField {
-            id
-            name
-            options {
-              id
-              name
-            }
-          }
-        }
-      }
-    }
-  }
-}
-"""
-)
-
-
 gh_set_body = gql(
     """
   mutation($id:ID!, $body:String!) {
@@ -1193,9 +1668,7 @@ gh_set_body = gql(
         body: $body
       }
     ) {
-      issue {
-        id
-      }
+      clientMutationId
     }
   }
 """
@@ -1210,9 +1683,7 @@ gh_setpr_body = gql(
         body: $body
       }
     ) {
-      pullRequest {
-        id
-      }
+      clientMutationId
     }
   }
 """
@@ -1231,9 +1702,7 @@ gh_set_value = gql(
         }
       }
     ) {
-      projectV2Item {
-        id
-      }
+      clientMutationId
     }
   }
 """
@@ -1252,9 +1721,7 @@ gh_set_number = gql(
         }
       }
     ) {
-      projectV2Item {
-        id
-      }
+      clientMutationId
     }
   }
 """
@@ -1273,9 +1740,26 @@ gh_set_option = gql(
         }
       }
     ) {
-      projectV2Item {
-        id
+      clientMutationId
+    }
+  }
+"""
+)
+
+gh_set_iteration = gql(
+    """
+  mutation($proj:ID!, $item:ID!, $field:ID!, $value:String) {
+    updateProjectV2ItemFieldValue(
+      input: {
+        projectId: $proj
+        itemId: $item
+        fieldId: $field
+        value: {
+          iterationId: $value
+        }
       }
+    ) {
+      clientMutationId
     }
   }
 """
@@ -1291,9 +1775,7 @@ gh_del_value = gql(
         fieldId: $field
       }
     ) {
-      projectV2Item {
-        id
-      }
+      clientMutationId
     }
   }
 """
@@ -1309,34 +1791,61 @@ gh_set_order = gql(
         afterId: $after
       }
     ) {
-      items(first:100) {
-        nodes {
-                   id
-        }
-      }
+      clientMutationId
     }
   }
 """
 )
 
+# the mutation that sets each kind of field
+FIELD_SETTERS = {
+    "SINGLE_SELECT": gh_set_option,
+    "ITERATION": gh_set_iteration,
+    "NUMBER": gh_set_number,
+    "TEXT": gh_set_value,
+}
 
-def main():
-    # turn my docopt args into python args
-    args = {k.strip("<>-- ").replace("-", "_").lower(): v for k, v in docopt(__doc__).items()}
-    stats = merge_workspaces(**args)
 
-    print()
-    print("Summary")
-    print("=======")
-    print("Added: {added}, Removed:{removed}, Text Changes:{text}".format(**stats))
-    print()
+def parse_args(argv=None):
+    """ command line options named as merge_workspaces arguments. The module doc is the help """
+    parser = argparse.ArgumentParser(
+        prog="projectsmigrator",
+        usage=argparse.SUPPRESS,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False,
+    )
+    for flags, kwargs in [
+        (["project_url"], dict()),
+        (["-w", "--workspace"], dict(action="append", default=[])),
+        (["-f", "--field"], dict(action="append", default=[])),
+        (["-x", "--exclude"], dict(action="append", default=[])),
+        (["--disable-remove"], dict(action="store_true")),
+        (["--github-token"], dict()),
+        (["--zenhub-token"], dict()),
+        (["--timeout"], dict(type=int, default=180)),
+        (["--concurrency"], dict(type=int, default=10)),
+        (["-h", "--help"], dict(action="help")),
+    ]:
+        parser.add_argument(*flags, help=argparse.SUPPRESS, **kwargs)
+    return vars(parser.parse_args(argv))
 
-    for fieldname, values in field_stats.items(): 
-        print(fieldname)
-        for from_to, count in values.items():
-            _from, to = from_to
-            print(f"\t{_from} -> {to}: {count}")
 
+def main():
+    stats = asyncio.run(merge_workspaces(**parse_args()))
+
+    # build the summary up and write it once
+    lines = [
+        "",
+        "Summary",
+        "=======",
+        "Added: {added}, Removed:{removed}, Text Changes:{text}".format(**stats),
+        "",
+    ]
+    for fieldname, values in stats["fields"].items():
+        lines.append(fieldname)
+        lines.extend(f"\t{_from} -> {to}: {count}" for (_from, to), count in values.items())
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":